@@ -1,14 +1,27 @@
+# cython: freethreading_compatible = True
+
+import collections
+import functools
 import io
+import itertools
 import json
+import os
+import stat
 import threading
 
 from cpython.bytes cimport PyBytes_AsString
 from cpython.bytes cimport PyBytes_AsStringAndSize
+from cpython.bytes cimport PyBytes_FromStringAndSize
+from cpython.mem cimport PyMem_Free, PyMem_Realloc
+from cpython.unicode cimport PyUnicode_AsUTF8AndSize
 from libc.float cimport DBL_MAX
+from libc.limits cimport INT_MAX
 from libc.math cimport INFINITY, modf
+from libc.stdint cimport int64_t, uint8_t, uint16_t, uint32_t, uint64_t
+from libc.string cimport memcpy
 
 
-cdef extern from "jv.h":
+cdef extern from "jv.h" nogil:
     ctypedef enum jv_kind:
       JV_KIND_INVALID,
       JV_KIND_NULL,
@@ -22,6 +35,10 @@ cdef extern from "jv.h":
     ctypedef struct jv:
         pass
 
+    jv jv_null()
+    jv jv_bool(int)
+    jv jv_number(double)
+
     # value: not consumed
     jv_kind jv_get_kind(jv value)
 
@@ -52,8 +69,12 @@ cdef extern from "jv.h":
     # value: not consumed
     double jv_number_value(jv)
 
+    jv jv_string_sized(const char*, int)
+
     jv jv_array()
 
+    jv jv_array_sized(int)
+
     # array: consumed
     # element: consumed
     jv jv_array_append(jv array, jv element)
@@ -64,6 +85,16 @@ cdef extern from "jv.h":
     # array: consumed
     jv jv_array_get(jv array, int index)
 
+    jv jv_object()
+
+    # object: consumed
+    # key: consumed
+    # value: consumed
+    jv jv_object_set(jv object, jv key, jv value)
+
+    # object: consumed
+    int jv_object_length(jv object)
+
     # value: not consumed
     int jv_object_iter(jv value)
 
@@ -101,11 +132,15 @@ cdef extern from "jq.h":
     int jq_compile(jq_state *, const char* str)
     int jq_compile_args(jq_state *, const char* str, jv)
     void jq_start(jq_state *, jv value, int flags)
-    jv jq_next(jq_state *)
+    jv jq_next(jq_state *) nogil
     void jq_set_error_cb(jq_state *, jq_err_cb, void *)
     void jq_get_error_cb(jq_state *, jq_err_cb *, void **)
 
 
+# Matches the depth limit used by jq's JSON parser.
+cdef int _MAX_PARSING_DEPTH = 10000
+
+
 cdef object _jv_to_python(jv value) noexcept:
     """Unpack a jv value into a Python value.
 
@@ -183,11 +218,446 @@ cdef int _is_integer(double value) noexcept:
     return fractional_part == 0
 
 
+# Integers up to this magnitude are represented exactly by doubles, so
+# converting them directly gives the same value as parsing their JSON text.
+cdef object _MAX_EXACT_INTEGER = 2 ** 53
+
+
+cdef bint _python_to_jv(object value, jv* result, int depth) except -1:
+    """Convert a Python value directly into a jv value.
+
+    The result is the same as serialising the value with json.dumps and then
+    parsing the JSON text with jq. Returns False without setting the result
+    for values that can't be converted exactly, such as floats, which jq
+    keeps as number literals when parsed from JSON text."""
+
+    cdef type value_type = type(value)
+    cdef const char* string_value
+    cdef Py_ssize_t length
+    cdef jv container
+    cdef jv property_key
+    cdef jv property_value
+
+    if depth >= _MAX_PARSING_DEPTH:
+        return False
+
+    if value is None:
+        result[0] = jv_null()
+
+    elif value is True:
+        result[0] = jv_bool(1)
+
+    elif value is False:
+        result[0] = jv_bool(0)
+
+    elif value_type is int:
+        if not -_MAX_EXACT_INTEGER <= value <= _MAX_EXACT_INTEGER:
+            return False
+        result[0] = jv_number(<double>value)
+
+    elif value_type is str:
+        try:
+            string_value = PyUnicode_AsUTF8AndSize(value, &length)
+        except UnicodeEncodeError:
+            return False
+        if length > INT_MAX:
+            return False
+        result[0] = jv_string_sized(string_value, <int>length)
+
+    elif value_type is list:
+        container = jv_array_sized(len(value))
+        try:
+            for element in value:
+                if not _python_to_jv(element, &property_value, depth + 1):
+                    jv_free(container)
+                    return False
+                container = jv_array_append(container, property_value)
+        except:
+            jv_free(container)
+            raise
+        result[0] = container
+
+    elif value_type is dict:
+        container = jv_object()
+        try:
+            for key, element in value.items():
+                if type(key) is not str or not _python_to_jv(key, &property_key, depth + 1):
+                    jv_free(container)
+                    return False
+                if not _python_to_jv(element, &property_value, depth + 1):
+                    jv_free(property_key)
+                    jv_free(container)
+                    return False
+                container = jv_object_set(container, property_key, property_value)
+        except:
+            jv_free(container)
+            raise
+        result[0] = container
+
+    else:
+        return False
+
+    return True
+
+
+cdef jv _python_value_to_jv(object value) except *:
+    """Convert a Python value into a jv value as if serialised with json.dumps."""
+
+    cdef bytes bytes_input
+    cdef char* cbytes_input
+    cdef ssize_t clen_input
+    cdef jv parsed
+
+    if _python_to_jv(value, &parsed, 0):
+        return parsed
+
+    # Parse in the same way as _ResultIterator so that errors are the same
+    # as for input_value.
+    bytes_input = json.dumps(value).encode("utf8")
+    PyBytes_AsStringAndSize(bytes_input, &cbytes_input, &clen_input)
+    cdef jv_parser* parser = jv_parser_new(0)
+    try:
+        jv_parser_set_buf(parser, cbytes_input, clen_input, 0)
+        return _check_parsed(jv_parser_next(parser))
+    finally:
+        jv_parser_free(parser)
+
+
+cdef class _MsgpackParser(object):
+    """Decode a sequence of concatenated MessagePack values into jv values."""
+
+    cdef bytes _bytes_input
+    cdef const uint8_t* _data
+    cdef Py_ssize_t _length
+    cdef Py_ssize_t _offset
+
+    def __cinit__(self, bytes bytes_input):
+        cdef char* cbytes_input
+        PyBytes_AsStringAndSize(bytes_input, &cbytes_input, &self._length)
+        self._bytes_input = bytes_input
+        self._data = <const uint8_t*>cbytes_input
+        self._offset = 0
+
+    cdef jv next(self) except *:
+        """Decode the next value, raising StopIteration at the end of the input."""
+
+        if self._offset == self._length:
+            raise StopIteration()
+
+        return self._read_value(0)
+
+    cdef const uint8_t* _take(self, Py_ssize_t length) except NULL:
+        cdef const uint8_t* start = self._data + self._offset
+        if length > self._length - self._offset:
+            raise ValueError(u"parse error: Unfinished MessagePack value at offset {}".format(self._offset))
+        self._offset += length
+        return start
+
+    cdef jv _read_value(self, int depth) except *:
+        cdef uint8_t marker = self._take(1)[0]
+
+        if marker <= 0x7f:
+            return jv_number(marker)
+        elif marker <= 0x8f:
+            return self._read_map(marker & 0x0f, depth)
+        elif marker <= 0x9f:
+            return self._read_array(marker & 0x0f, depth)
+        elif marker <= 0xbf:
+            return self._read_string(marker & 0x1f)
+        elif marker == 0xc0:
+            return jv_null()
+        elif marker == 0xc2:
+            return jv_bool(0)
+        elif marker == 0xc3:
+            return jv_bool(1)
+        elif marker == 0xca:
+            return jv_number(_load_float32(self._take(4)))
+        elif marker == 0xcb:
+            return jv_number(_load_float64(self._take(8)))
+        elif marker == 0xcc:
+            return jv_number(self._take(1)[0])
+        elif marker == 0xcd:
+            return jv_number(_load_uint16(self._take(2)))
+        elif marker == 0xce:
+            return jv_number(_load_uint32(self._take(4)))
+        elif marker == 0xcf:
+            return jv_number(<double>_load_uint64(self._take(8)))
+        elif marker == 0xd0:
+            return jv_number(<signed char>self._take(1)[0])
+        elif marker == 0xd1:
+            return jv_number(<short>_load_uint16(self._take(2)))
+        elif marker == 0xd2:
+            return jv_number(<int>_load_uint32(self._take(4)))
+        elif marker == 0xd3:
+            return jv_number(<double><int64_t>_load_uint64(self._take(8)))
+        elif marker == 0xd9:
+            return self._read_string(self._take(1)[0])
+        elif marker == 0xda:
+            return self._read_string(_load_uint16(self._take(2)))
+        elif marker == 0xdb:
+            return self._read_string(_load_uint32(self._take(4)))
+        elif marker == 0xdc:
+            return self._read_array(_load_uint16(self._take(2)), depth)
+        elif marker == 0xdd:
+            return self._read_array(_load_uint32(self._take(4)), depth)
+        elif marker == 0xde:
+            return self._read_map(_load_uint16(self._take(2)), depth)
+        elif marker == 0xdf:
+            return self._read_map(_load_uint32(self._take(4)), depth)
+        elif marker >= 0xe0:
+            return jv_number(<signed char>marker)
+        else:
+            # bin, ext and the never-used 0xc1 have no JSON equivalent.
+            raise ValueError(u"parse error: Unsupported MessagePack type 0x{:02x} at offset {}".format(marker, self._offset - 1))
+
+    cdef jv _read_string(self, Py_ssize_t length) except *:
+        if length > INT_MAX:
+            raise ValueError(u"parse error: MessagePack string is too long")
+        return jv_string_sized(<const char*>self._take(length), <int>length)
+
+    cdef jv _read_array(self, Py_ssize_t length, int depth) except *:
+        cdef jv value
+        cdef jv element
+        cdef Py_ssize_t idx
+
+        if depth >= _MAX_PARSING_DEPTH:
+            raise ValueError(u"parse error: Exceeds depth limit for parsing")
+
+        # Each element takes at least one byte, so a truncated input can't
+        # cause a huge preallocation.
+        if length > self._length - self._offset:
+            self._take(length)
+
+        value = jv_array_sized(<int>length)
+        for idx in range(length):
+            try:
+                element = self._read_value(depth + 1)
+            except:
+                jv_free(value)
+                raise
+            value = jv_array_append(value, element)
+        return value
+
+    cdef jv _read_map(self, Py_ssize_t length, int depth) except *:
+        cdef jv value
+        cdef jv property_key
+        cdef jv property_value
+        cdef Py_ssize_t idx
+
+        if depth >= _MAX_PARSING_DEPTH:
+            raise ValueError(u"parse error: Exceeds depth limit for parsing")
+
+        value = jv_object()
+        for idx in range(length):
+            try:
+                property_key = self._read_value(depth + 1)
+            except:
+                jv_free(value)
+                raise
+            if jv_get_kind(property_key) != JV_KIND_STRING:
+                jv_free(property_key)
+                jv_free(value)
+                raise ValueError(u"parse error: MessagePack map keys must be strings")
+            try:
+                property_value = self._read_value(depth + 1)
+            except:
+                jv_free(property_key)
+                jv_free(value)
+                raise
+            value = jv_object_set(value, property_key, property_value)
+        return value
+
+
+cdef inline uint16_t _load_uint16(const uint8_t* data) noexcept:
+    return (<uint16_t>data[0] << 8) | data[1]
+
+
+cdef inline uint32_t _load_uint32(const uint8_t* data) noexcept:
+    return (
+        (<uint32_t>data[0] << 24) |
+        (<uint32_t>data[1] << 16) |
+        (<uint32_t>data[2] << 8) |
+        data[3]
+    )
+
+
+cdef inline uint64_t _load_uint64(const uint8_t* data) noexcept:
+    return (<uint64_t>_load_uint32(data) << 32) | _load_uint32(data + 4)
+
+
+cdef inline double _load_float32(const uint8_t* data) noexcept:
+    cdef uint32_t bits = _load_uint32(data)
+    cdef float value
+    memcpy(&value, &bits, 4)
+    return value
+
+
+cdef inline double _load_float64(const uint8_t* data) noexcept:
+    cdef uint64_t bits = _load_uint64(data)
+    cdef double value
+    memcpy(&value, &bits, 8)
+    return value
+
+
+cdef class _MsgpackWriter(object):
+    """Encode jv values as concatenated MessagePack values.
+
+    Values are converted in the same way as _jv_to_python: invalid values and
+    NaN become nil, infinities are clamped to the largest finite double, and
+    integral numbers are written as integers."""
+
+    cdef char* _buffer
+    cdef Py_ssize_t _length
+    cdef Py_ssize_t _capacity
+
+    def __dealloc__(self):
+        PyMem_Free(self._buffer)
+
+    cdef bytes getvalue(self):
+        return PyBytes_FromStringAndSize(self._buffer, self._length)
+
+    cdef uint8_t* _reserve(self, Py_ssize_t length) except NULL:
+        cdef Py_ssize_t capacity
+        cdef char* buffer
+
+        if self._length + length > self._capacity:
+            capacity = max(self._capacity * 2, self._length + length, 256)
+            buffer = <char*>PyMem_Realloc(self._buffer, capacity)
+            if buffer == NULL:
+                raise MemoryError()
+            self._buffer = buffer
+            self._capacity = capacity
+
+        cdef uint8_t* start = <uint8_t*>self._buffer + self._length
+        self._length += length
+        return start
+
+    cdef void _write_header(self, uint8_t marker, uint64_t value, int size) except *:
+        cdef uint8_t* data = self._reserve(1 + size)
+        cdef int idx
+        data[0] = marker
+        for idx in range(size):
+            data[size - idx] = (value >> (8 * idx)) & 0xff
+
+    cdef void _write_float64(self, double value) except *:
+        cdef uint64_t bits
+        memcpy(&bits, &value, 8)
+        self._write_header(0xcb, bits, 8)
+
+    cdef void _write_number(self, double value) except *:
+        cdef uint64_t unsigned_value
+        cdef int64_t signed_value
+
+        if value != value:
+            self._reserve(1)[0] = 0xc0
+        elif value == INFINITY:
+            self._write_float64(DBL_MAX)
+        elif value == -INFINITY:
+            self._write_float64(-DBL_MAX)
+        elif not _is_integer(value) or value < -9223372036854775808.0 or value >= 18446744073709551616.0:
+            self._write_float64(value)
+        elif value >= 0:
+            unsigned_value = <uint64_t>value
+            if unsigned_value <= 0x7f:
+                self._reserve(1)[0] = <uint8_t>unsigned_value
+            elif unsigned_value <= 0xff:
+                self._write_header(0xcc, unsigned_value, 1)
+            elif unsigned_value <= 0xffff:
+                self._write_header(0xcd, unsigned_value, 2)
+            elif unsigned_value <= 0xffffffff:
+                self._write_header(0xce, unsigned_value, 4)
+            else:
+                self._write_header(0xcf, unsigned_value, 8)
+        else:
+            signed_value = <int64_t>value
+            if signed_value >= -32:
+                self._reserve(1)[0] = <uint8_t>signed_value
+            elif signed_value >= -0x80:
+                self._write_header(0xd0, <uint64_t>signed_value, 1)
+            elif signed_value >= -0x8000:
+                self._write_header(0xd1, <uint64_t>signed_value, 2)
+            elif signed_value >= -0x80000000:
+                self._write_header(0xd2, <uint64_t>signed_value, 4)
+            else:
+                self._write_header(0xd3, <uint64_t>signed_value, 8)
+
+    cdef void _write_string(self, jv value) except *:
+        """Does not consume its input."""
+
+        cdef Py_ssize_t length = jv_string_length_bytes(jv_copy(value))
+
+        if length <= 0x1f:
+            self._reserve(1)[0] = 0xa0 | length
+        elif length <= 0xff:
+            self._write_header(0xd9, length, 1)
+        elif length <= 0xffff:
+            self._write_header(0xda, length, 2)
+        else:
+            self._write_header(0xdb, length, 4)
+
+        memcpy(self._reserve(length), jv_string_value(value), length)
+
+    cdef void _write_container_header(self, uint8_t fix_marker, uint8_t marker_16, Py_ssize_t length) except *:
+        if length <= 0x0f:
+            self._reserve(1)[0] = fix_marker | length
+        elif length <= 0xffff:
+            self._write_header(marker_16, length, 2)
+        else:
+            self._write_header(marker_16 + 1, length, 4)
+
+    cdef void write_value(self, jv value) except *:
+        """Consumes the input value."""
+
+        cdef jv_kind kind = jv_get_kind(value)
+        cdef int idx
+        cdef int length
+        cdef jv property_key
+
+        try:
+            if kind == JV_KIND_FALSE:
+                self._reserve(1)[0] = 0xc2
+
+            elif kind == JV_KIND_TRUE:
+                self._reserve(1)[0] = 0xc3
+
+            elif kind == JV_KIND_NUMBER:
+                self._write_number(jv_number_value(value))
+
+            elif kind == JV_KIND_STRING:
+                self._write_string(value)
+
+            elif kind == JV_KIND_ARRAY:
+                length = jv_array_length(jv_copy(value))
+                self._write_container_header(0x90, 0xdc, length)
+                for idx in range(0, length):
+                    self.write_value(jv_array_get(jv_copy(value), idx))
+
+            elif kind == JV_KIND_OBJECT:
+                self._write_container_header(0x80, 0xde, jv_object_length(jv_copy(value)))
+                idx = jv_object_iter(value)
+                while jv_object_iter_valid(value, idx):
+                    property_key = jv_object_iter_key(value, idx)
+                    try:
+                        self._write_string(property_key)
+                    finally:
+                        jv_free(property_key)
+                    self.write_value(jv_object_iter_value(value, idx))
+                    idx = jv_object_iter_next(value, idx)
+
+            else:
+                self._reserve(1)[0] = 0xc0
+        finally:
+            jv_free(value)
+
+
 def compile(object program, args=None):
     cdef object program_bytes = program.encode("utf8")
     return _Program(program_bytes, args=args)
 
 
+# Compilation is serialised across all threads, and the error store is only
+# attached to the jq state for the duration of compilation. Once compiled, a
+# jq state is only ever used by one thread at a time.
 _compilation_lock = threading.Lock()
 
 
@@ -212,6 +682,10 @@ cdef jq_state* _compile(object program_bytes, object args) except NULL:
                 jv_args = jv_parse(PyBytes_AsString(args_bytes))
                 compiled = jq_compile_args(jq, program_bytes, jv_args)
 
+            # The error store is only referenced by this frame, so the
+            # callback must not outlive compilation.
+            jq_set_error_cb(jq, NULL, NULL)
+
             if error_store.has_errors():
                 raise ValueError(error_store.error_string())
 
@@ -220,7 +694,6 @@ cdef jq_state* _compile(object program_bytes, object args) except NULL:
     except:
         jq_teardown(&jq)
         raise
-    # TODO: unset error callback?
 
     return jq
 
@@ -274,35 +747,62 @@ _NO_VALUE = _EmptyValue()
 
 
 cdef class _JqStatePool(object):
-    cdef jq_state* _jq_state
+    """Hand out compiled jq states for a single program.
+
+    Each thread keeps its own idle state, so acquiring and releasing a state
+    on the same thread doesn't require any locking. A state may be released
+    on a different thread to the one that acquired it, in which case it
+    becomes the idle state of the releasing thread."""
+
     cdef object _program_bytes
     cdef object _args
-    cdef object _lock
+    cdef object _thread_local
 
     def __cinit__(self, program_bytes, args):
         self._program_bytes = program_bytes
         self._args = args
-        self._jq_state = _compile(self._program_bytes, args=self._args)
-        self._lock = threading.Lock()
+        self._thread_local = threading.local()
+        self.release(_compile(self._program_bytes, args=self._args))
 
-    def __dealloc__(self):
-        jq_teardown(&self._jq_state)
+    cdef _IdleJqState _idle_state(self):
+        cdef _IdleJqState idle_state
+        try:
+            return self._thread_local.idle_state
+        except AttributeError:
+            idle_state = _IdleJqState()
+            self._thread_local.idle_state = idle_state
+            return idle_state
 
     cdef jq_state* acquire(self):
-        with self._lock:
-            if self._jq_state == NULL:
-                return _compile(self._program_bytes, args=self._args)
-            else:
-                state = self._jq_state
-                self._jq_state = NULL
-                return state
+        cdef jq_state* state = self._idle_state().take()
+        if state == NULL:
+            return _compile(self._program_bytes, args=self._args)
+        else:
+            return state
 
     cdef void release(self, jq_state* state):
-        with self._lock:
-            if self._jq_state == NULL:
-                self._jq_state = state
-            else:
-                jq_teardown(&state)
+        if state != NULL:
+            self._idle_state().put(state)
+
+
+cdef class _IdleJqState(object):
+    """Hold at most one idle jq state for a single thread."""
+
+    cdef jq_state* _jq_state
+
+    def __dealloc__(self):
+        jq_teardown(&self._jq_state)
+
+    cdef jq_state* take(self):
+        cdef jq_state* state = self._jq_state
+        self._jq_state = NULL
+        return state
+
+    cdef void put(self, jq_state* state):
+        if self._jq_state == NULL:
+            self._jq_state = state
+        else:
+            jq_teardown(&state)
 
 
 cdef class _Program(object):
@@ -325,15 +825,60 @@ cdef class _Program(object):
     def input_value(self, value):
         return self.input_text(json.dumps(value))
 
-    def input_values(self, values):
+    def input_values(self, values, *, slurp=False):
+        if slurp:
+            values = list(values)
+            return self._with_input(values, _VALUES_INPUT, slurp=True, slurp_size_hint=len(values), max_slurp_size_hint=len(values))
+
         fileobj = io.StringIO()
         for value in values:
             json.dump(value, fileobj)
             fileobj.write("\n")
         return self.input_text(fileobj.getvalue())
 
-    def input_text(self, text, *, slurp=False):
-        return _ProgramWithInput(self._jq_state_pool, text.encode("utf8"), slurp=slurp)
+    def input_text(self, text, *, slurp=False, slurp_size_hint=None):
+        bytes_input = text if isinstance(text, bytes) else text.encode("utf8")
+        # Every value but the last takes at least two bytes of text, since
+        # single byte values need to be separated by whitespace.
+        return self._with_input(bytes_input, _JSON_TEXT_INPUT, slurp=slurp, slurp_size_hint=slurp_size_hint, max_slurp_size_hint=(len(bytes_input) + 1) // 2)
+
+    def input_file(self, fileobj, *, slurp=False, slurp_size_hint=None):
+        if slurp and slurp_size_hint is not None:
+            file_size = _file_size(fileobj)
+        else:
+            file_size = None
+        if file_size is None:
+            max_slurp_size_hint = _MAX_FILE_SLURP_SIZE_HINT
+        else:
+            # As for input_text, every value but the last takes at least two
+            # bytes (or characters) of text.
+            max_slurp_size_hint = (file_size + 1) // 2
+        return self._with_input(fileobj, _JSON_FILE_INPUT, slurp=slurp, slurp_size_hint=slurp_size_hint, max_slurp_size_hint=max_slurp_size_hint)
+
+    def input_msgpack(self, data, *, slurp=False, slurp_size_hint=None):
+        bytes_input = data if isinstance(data, bytes) else bytes(memoryview(data))
+        # Every value takes at least one byte.
+        return self._with_input(bytes_input, _MSGPACK_INPUT, slurp=slurp, slurp_size_hint=slurp_size_hint, max_slurp_size_hint=len(bytes_input))
+
+    cdef _ProgramWithInput _with_input(self, input, _InputKind kind, bint slurp, slurp_size_hint, Py_ssize_t max_slurp_size_hint):
+        # libjq aborts the process if an allocation fails, so the hint is
+        # clamped to the most values that the input could contain, and to the
+        # largest array that libjq allows.
+        if slurp_size_hint is None:
+            slurp_size_hint = 0
+        else:
+            slurp_size_hint = max(0, min(slurp_size_hint, max_slurp_size_hint, _MAX_SLURP_SIZE_HINT))
+
+        return _ProgramWithInput(
+            self._jq_state_pool,
+            input,
+            kind=kind,
+            slurp=slurp,
+            slurp_size_hint=slurp_size_hint,
+        )
+
+    def runner(self):
+        return _Runner(self._jq_state_pool)
 
     @property
     def program_string(self):
@@ -353,21 +898,81 @@ cdef class _Program(object):
             return program_with_input.first()
 
 
+cdef enum _InputKind:
+    # bytes of JSON text
+    _JSON_TEXT_INPUT
+    # file object containing JSON text, read incrementally
+    _JSON_FILE_INPUT
+    # bytes of concatenated MessagePack values
+    _MSGPACK_INPUT
+    # list of Python values
+    _VALUES_INPUT
+
+
+# Matches the buffer size used by the jq command line tool.
+cdef Py_ssize_t _FILE_CHUNK_SIZE = 64 * 1024
+
+# Matches the largest array length allowed by jv_array_set.
+cdef int _MAX_SLURP_SIZE_HINT = INT_MAX >> 2
+
+# jv_parser_set_buf takes an int length, so larger buffers are given to the
+# parser in slices. This is a Python global so that tests can shrink it.
+_MAX_PARSER_BUF_SIZE = INT_MAX
+
+# When the size of a file isn't known, the slurp size hint for file input is
+# clamped to a fixed bound. Larger inputs grow the array as usual.
+cdef Py_ssize_t _MAX_FILE_SLURP_SIZE_HINT = 2 ** 20
+
+
+cdef object _file_size(object fileobj):
+    """Return an upper bound on the size of a file object, or None if it's unknown."""
+
+    try:
+        file_stat = os.fstat(fileobj.fileno())
+    except (AttributeError, OSError, ValueError):
+        pass
+    else:
+        # Pipes and other special files report a size of zero.
+        if stat.S_ISREG(file_stat.st_mode):
+            return file_stat.st_size
+
+    try:
+        if fileobj.seekable():
+            position = fileobj.tell()
+            size = fileobj.seek(0, io.SEEK_END)
+            fileobj.seek(position)
+            return size
+    except (AttributeError, OSError, ValueError):
+        pass
+
+    return None
+
+
 cdef class _ProgramWithInput(object):
     cdef _JqStatePool _jq_state_pool
-    cdef object _bytes_input
+    cdef object _input
+    cdef _InputKind _kind
     cdef bint _slurp
+    cdef int _slurp_size_hint
 
-    def __cinit__(self, jq_state_pool, bytes_input, *, bint slurp):
+    def __cinit__(self, jq_state_pool, input, *, _InputKind kind, bint slurp, int slurp_size_hint):
         self._jq_state_pool = jq_state_pool
-        self._bytes_input = bytes_input
+        self._input = input
+        self._kind = kind
         self._slurp = slurp
+        self._slurp_size_hint = slurp_size_hint
 
     def __iter__(self):
         return self._make_iterator()
 
     cdef _ResultIterator _make_iterator(self):
-        return _ResultIterator(self._jq_state_pool, self._bytes_input, slurp=self._slurp)
+        return _ResultIterator(
+            self._jq_state_pool,
+            self._input,
+            kind=self._kind,
+            slurp=self._slurp,
+            slurp_size_hint=self._slurp_size_hint,
+        )
 
     def text(self):
         # Performance testing suggests that using _jv_to_python (within the
@@ -376,57 +981,184 @@ cdef class _ProgramWithInput(object):
         # See: https://github.com/mwilliamson/jq.py/pull/50
         return "\n".join(json.dumps(v) for v in self)
 
+    def msgpack(self):
+        cdef _ResultIterator iterator = self._make_iterator()
+        cdef _MsgpackWriter writer = _MsgpackWriter()
+        cdef jv value
+
+        try:
+            while True:
+                try:
+                    value = iterator._next_jv()
+                except StopIteration:
+                    return writer.getvalue()
+                writer.write_value(value)
+        finally:
+            iterator.close()
+
     def all(self):
         return list(self)
 
     def first(self):
-        return next(_iter(self))
+        cdef _ResultIterator iterator = self._make_iterator()
+        try:
+            return next(iterator)
+        finally:
+            iterator.close()
+
+
+cdef class _Runner(object):
+    """Run a program repeatedly against single values.
+
+    The runner holds on to one jq state between calls rather than going
+    through the state pool each time. The state is returned to the pool by
+    close(), and is reacquired if the runner is used again.
+
+    The GIL is released while running the program, so the runner's own
+    lock is held for each call to stop threads using the jq state at the
+    same time."""
+
+    cdef _JqStatePool _jq_state_pool
+    cdef jq_state* _jq
+    cdef object _lock
+
+    def __cinit__(self, _JqStatePool jq_state_pool):
+        self._jq_state_pool = jq_state_pool
+        self._jq = jq_state_pool.acquire()
+        self._lock = threading.Lock()
+
+    def __dealloc__(self):
+        if self._jq != NULL:
+            self._jq_state_pool.release(self._jq)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if self._jq != NULL:
+                self._jq_state_pool.release(self._jq)
+                self._jq = NULL
+
+    def run_first(self, value):
+        cdef jv result
+        with self._lock:
+            self._start(value)
+            if _jq_next(self._jq, &result):
+                return _jv_to_python(result)
+            else:
+                raise StopIteration()
+
+    def run_all(self, value):
+        cdef jv result
+        cdef list results = []
+        with self._lock:
+            self._start(value)
+            while _jq_next(self._jq, &result):
+                results.append(_jv_to_python(result))
+        return results
+
+    cdef int _start(self, value) except -1:
+        if self._jq == NULL:
+            self._jq = self._jq_state_pool.acquire()
+
+        jq_start(self._jq, _python_value_to_jv(value), 0)
+        return 0
+
+
+cdef bint _jq_next(jq_state* jq, jv* result) except -1:
+    """Get the next output of jq for the current input.
+
+    Returns False if there are no more outputs for the current input."""
+
+    cdef jv value
+    with nogil:
+        value = jq_next(jq)
+    if jv_is_valid(value):
+        result[0] = value
+        return True
+    elif jv_invalid_has_msg(jv_copy(value)):
+        error_message = jv_invalid_get_msg(value)
+        message = _jq_error_to_py_string(error_message)
+        jv_free(error_message)
+        raise ValueError(message)
+    else:
+        jv_free(value)
+        return False
 
 
 cdef class _ResultIterator(object):
     cdef _JqStatePool _jq_state_pool
     cdef jq_state* _jq
     cdef jv_parser* _parser
+    cdef _MsgpackParser _msgpack_parser
+    cdef object _values_iterator
+    cdef object _fileobj
     cdef bytes _bytes_input
+    cdef Py_ssize_t _bytes_input_offset
+    cdef bint _bytes_input_is_partial
     cdef bint _slurp
+    cdef int _slurp_size_hint
     cdef bint _ready
+    cdef object _lock
 
     def __dealloc__(self):
-        self._jq_state_pool.release(self._jq)
-        jv_parser_free(self._parser)
+        self.close()
 
-    def __cinit__(self, _JqStatePool jq_state_pool, bytes bytes_input, *, bint slurp):
+    def __cinit__(self, _JqStatePool jq_state_pool, object input, *, _InputKind kind, bint slurp, int slurp_size_hint):
         self._jq_state_pool = jq_state_pool
         self._jq = jq_state_pool.acquire()
-        self._bytes_input = bytes_input
+        self._lock = threading.Lock()
         self._slurp = slurp
+        self._slurp_size_hint = slurp_size_hint
         self._ready = False
-        cdef jv_parser* parser = jv_parser_new(0)
-        cdef char* cbytes_input
-        cdef ssize_t clen_input
-        PyBytes_AsStringAndSize(bytes_input, &cbytes_input, &clen_input)
-        jv_parser_set_buf(parser, cbytes_input, clen_input, 0)
-        self._parser = parser
+        if kind == _MSGPACK_INPUT:
+            self._msgpack_parser = _MsgpackParser(input)
+        elif kind == _VALUES_INPUT:
+            self._values_iterator = _iter(input)
+        else:
+            self._parser = jv_parser_new(0)
+            if kind == _JSON_FILE_INPUT:
+                # The parser is given the first chunk of the file when it
+                # first asks for more input.
+                self._fileobj = input
+            else:
+                self._set_parser_buf(input, is_partial=False)
 
     def __iter__(self):
         return self
 
+    # The jq state can't be used by multiple threads at once, and the GIL is
+    # released while running the program, so concurrent calls to __next__
+    # on the same iterator are serialised by the iterator's own lock.
     def __next__(self):
+        with self._lock:
+            return _jv_to_python(self._next_jv())
+
+    cdef void close(self):
+        """Return the jq state to the pool without waiting for deallocation."""
+
+        if self._jq != NULL:
+            self._jq_state_pool.release(self._jq)
+            self._jq = NULL
+        if self._parser != NULL:
+            jv_parser_free(self._parser)
+            self._parser = NULL
+
+    cdef jv _next_jv(self) except *:
+        cdef jv result
+
         while True:
             if not self._ready:
                 self._ready_next_input()
                 self._ready = True
 
-            result = jq_next(self._jq)
-            if jv_is_valid(result):
-                return _jv_to_python(result)
-            elif jv_invalid_has_msg(jv_copy(result)):
-                error_message = jv_invalid_get_msg(result)
-                message = _jq_error_to_py_string(error_message)
-                jv_free(error_message)
-                raise ValueError(message)
+            if _jq_next(self._jq, &result):
+                return result
             else:
-                jv_free(result)
                 self._ready = False
 
     cdef bint _ready_next_input(self) except 1:
@@ -434,36 +1166,150 @@ cdef class _ResultIterator(object):
         cdef jv value
 
         if self._slurp:
-            value = jv_array()
+            value = self._slurp_inputs()
+            self._slurp = False
+        else:
+            value = self._parse_next_input()
+
+        jq_start(self._jq, value, jq_flags)
+        return 0
+
+    cdef jv _slurp_inputs(self) except *:
+        cdef jv values
+        cdef jv next_value
+
+        if self._slurp_size_hint > 0:
+            values = jv_array_sized(self._slurp_size_hint)
+        else:
+            values = jv_array()
 
+        if self._parser == NULL:
             while True:
                 try:
                     next_value = self._parse_next_input()
-                    value = jv_array_append(value, next_value)
                 except StopIteration:
-                    self._slurp = False
-                    break
+                    return values
                 except:
-                    jv_free(value)
+                    jv_free(values)
                     raise
+                values = jv_array_append(values, next_value)
+
+        # The GIL is released while parsing, so this relies on the caller
+        # holding the iterator's lock to keep the parser to one thread.
+        while True:
+            with nogil:
+                values = _parse_all(self._parser, values)
+            if not self._has_more_input() or not jv_is_valid(values):
+                return _check_parsed(values)
+            try:
+                self._feed_parser()
+            except:
+                jv_free(values)
+                raise
+
+    cdef inline jv _parse_next_input(self) except *:
+        cdef jv value
+
+        if self._msgpack_parser is not None:
+            return self._msgpack_parser.next()
+
+        if self._values_iterator is not None:
+            return _python_value_to_jv(next(self._values_iterator))
+
+        value = jv_parser_next(self._parser)
+        while self._has_more_input() and not jv_is_valid(value) and not jv_invalid_has_msg(jv_copy(value)):
+            jv_free(value)
+            self._feed_parser()
+            value = jv_parser_next(self._parser)
+        return _check_parsed(value)
+
+    cdef inline bint _has_more_input(self):
+        return self._has_more_slices() or self._fileobj is not None
+
+    cdef inline bint _has_more_slices(self):
+        return self._bytes_input is not None and self._bytes_input_offset < len(self._bytes_input)
+
+    cdef int _feed_parser(self) except -1:
+        """Give the parser the next slice of the buffer, or the next chunk of the input file."""
+
+        if self._has_more_slices():
+            return self._feed_parser_slice()
+
+        chunk = self._fileobj.read(_FILE_CHUNK_SIZE)
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf8")
         else:
-            value = self._parse_next_input()
+            chunk = bytes(chunk)
 
-        jq_start(self._jq, value, jq_flags)
+        if chunk:
+            self._set_parser_buf(chunk, is_partial=True)
+        else:
+            self._fileobj = None
+            self._set_parser_buf(b"", is_partial=False)
         return 0
 
-    cdef inline jv _parse_next_input(self) except *:
-        cdef jv value = jv_parser_next(self._parser)
+    cdef int _set_parser_buf(self, bytes bytes_input, bint is_partial) except -1:
+        # The parser doesn't copy its buffer, so keep the bytes alive until
+        # the parser is given another buffer.
+        self._bytes_input = bytes_input
+        self._bytes_input_offset = 0
+        self._bytes_input_is_partial = is_partial
+        return self._feed_parser_slice()
+
+    cdef int _feed_parser_slice(self) except -1:
+        cdef char* cbytes_input
+        cdef ssize_t clen_input
+        cdef Py_ssize_t slice_size = _MAX_PARSER_BUF_SIZE
+        cdef bint is_last_slice
+
+        PyBytes_AsStringAndSize(self._bytes_input, &cbytes_input, &clen_input)
+        slice_size = min(slice_size, clen_input - self._bytes_input_offset)
+        is_last_slice = self._bytes_input_offset + slice_size == clen_input
+        jv_parser_set_buf(
+            self._parser,
+            cbytes_input + self._bytes_input_offset,
+            <int>slice_size,
+            self._bytes_input_is_partial or not is_last_slice,
+        )
+        self._bytes_input_offset += slice_size
+        return 0
+
+
+cdef jv _parse_all(jv_parser* parser, jv values) noexcept nogil:
+    """Append values from the parser to an array until the parser runs out of input.
+
+    If parsing fails, the array is freed and the invalid value from the
+    parser is returned instead."""
+
+    cdef jv value
+
+    while True:
+        value = jv_parser_next(parser)
         if jv_is_valid(value):
-            return value
+            values = jv_array_append(values, value)
         elif jv_invalid_has_msg(jv_copy(value)):
-            error_message = jv_invalid_get_msg(value)
-            message = _jq_error_to_py_string(error_message)
-            jv_free(error_message)
-            raise ValueError(u"parse error: " + message)
+            jv_free(values)
+            return value
         else:
             jv_free(value)
-            raise StopIteration()
+            return values
+
+
+cdef jv _check_parsed(jv value) except *:
+    """Raise an error if the value returned by the parser is invalid.
+
+    Raises StopIteration if the parser has no more values."""
+
+    if jv_is_valid(value):
+        return value
+    elif jv_invalid_has_msg(jv_copy(value)):
+        error_message = jv_invalid_get_msg(value)
+        message = _jq_error_to_py_string(error_message)
+        jv_free(error_message)
+        raise ValueError(u"parse error: " + message)
+    else:
+        jv_free(value)
+        raise StopIteration()
 
 
 def all(program, value=_NO_VALUE, text=_NO_VALUE):
@@ -485,6 +1331,86 @@ def text(program, value=_NO_VALUE, text=_NO_VALUE):
     return compile(program).input(value, text=text).text()
 
 
+def map_reduce(chunk_program, merge_program, lines, *, chunk_size=10000, executor=None, max_pending=None):
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1")
+
+    if max_pending is not None and max_pending < 1:
+        raise ValueError("max_pending must be at least 1")
+
+    if isinstance(lines, (str, bytes)):
+        lines = lines.splitlines()
+
+    # Compile both programs up front so that invalid programs are reported
+    # before any input is read.
+    _compile_cached(chunk_program)
+    merge_runner = compile(merge_program).runner()
+
+    chunks = _ndjson_chunks(lines, chunk_size)
+    partial_results = _map_chunks(chunk_program, chunks, executor, max_pending)
+    merged = None
+    try:
+        for partial_result in partial_results:
+            if merged is None:
+                merged = merge_runner.run_all(partial_result)
+            else:
+                merged = merge_runner.run_all(merged + partial_result)
+
+        if merged is None:
+            merged = merge_runner.run_all([])
+    finally:
+        partial_results.close()
+        merge_runner.close()
+
+    return merged
+
+
+def _map_chunks(chunk_program, chunks, executor, max_pending):
+    if executor is None:
+        for chunk in chunks:
+            yield _map_chunk(chunk_program, chunk)
+        return
+
+    # Limit the number of chunks held in memory at once, while still
+    # keeping every worker busy. The standard library executors expose their
+    # worker count as the undocumented _max_workers. Other executors fall
+    # back to the CPU count.
+    if max_pending is None:
+        max_workers = getattr(executor, "_max_workers", None) or os.cpu_count() or 1
+        max_pending = 2 * max_workers
+    pending = collections.deque()
+    try:
+        for chunk in chunks:
+            pending.append(executor.submit(_map_chunk, chunk_program, chunk))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def _ndjson_chunks(lines, chunk_size):
+    lines_iterator = _iter(lines)
+    while True:
+        chunk = list(itertools.islice(lines_iterator, chunk_size))
+        if not chunk:
+            return
+        elif isinstance(chunk[0], bytes):
+            yield b"\n".join(chunk)
+        else:
+            yield "\n".join(chunk)
+
+
+_compile_cached = functools.lru_cache(maxsize=32)(compile)
+
+
+def _map_chunk(program, text):
+    return _compile_cached(program).input_text(text, slurp=True).all()
+
+
 # Support the 0.1.x API for backwards compatibility
 def jq(object program):
     return compile(program)
@@ -2,6 +2,13 @@
 
 from __future__ import unicode_literals
 
+import io
+import json
+import sys
+import sysconfig
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import jq
 from .tools import assert_equal, assert_is
 
@@ -140,6 +147,198 @@ def test_slurping_invalid_input_text_raises_error():
         assert_equal(str(error), expected_error_str)
 
 
+def test_input_text_can_be_bytes():
+    program = jq.compile(".")
+
+    result = program.input_text(b'"\xc3\xa9"\n2').all()
+
+    assert_equal(["\u00e9", 2], result)
+
+
+def test_slurp_size_hint_does_not_change_slurped_input():
+    program = jq.compile(".")
+
+    result = program.input_text("1\n2\n3", slurp=True, slurp_size_hint=2).first()
+
+    assert_equal([1, 2, 3], result)
+
+
+def test_oversized_slurp_size_hint_is_clamped():
+    program = jq.compile(".")
+
+    assert_equal([1, 2], program.input_text("1 2", slurp=True, slurp_size_hint=2 ** 31 - 1).first())
+    assert_equal([1, 2], program.input_text("1 2", slurp=True, slurp_size_hint=2 ** 100).first())
+    assert_equal([1, 2], program.input_file(io.BytesIO(b"1 2"), slurp=True, slurp_size_hint=2 ** 31 - 1).first())
+    assert_equal([1, 2], program.input_msgpack(b"\x01\x02", slurp=True, slurp_size_hint=2 ** 31 - 1).first())
+    assert_equal([1, 2], program.input_msgpack(b"\x01\x02", slurp=True, slurp_size_hint=2 ** 100).first())
+    assert_equal([1], program.input_text("1", slurp=True, slurp_size_hint=2 ** 31 - 1).first())
+
+
+def test_slurp_size_hint_is_clamped_for_files_of_unknown_size():
+    class UnseekableFile(object):
+        def __init__(self, data):
+            self._fileobj = io.BytesIO(data)
+
+        def read(self, size):
+            return self._fileobj.read(size)
+
+    program = jq.compile(".")
+
+    result = program.input_file(UnseekableFile(b"1 2"), slurp=True, slurp_size_hint=2 ** 31 - 1).first()
+
+    assert_equal([1, 2], result)
+
+
+def test_slurp_size_hint_does_not_move_file_position():
+    fileobj = io.BytesIO(b"1 2 3")
+    fileobj.read(2)
+    program = jq.compile(".")
+
+    result = program.input_file(fileobj, slurp=True, slurp_size_hint=2).first()
+
+    assert_equal([2, 3], result)
+
+
+def test_negative_slurp_size_hint_is_ignored():
+    program = jq.compile(".")
+
+    result = program.input_text("1 2", slurp=True, slurp_size_hint=-1).first()
+
+    assert_equal([1, 2], result)
+
+
+def test_can_slurp_multiple_values():
+    program = jq.compile(".")
+
+    result = program.input_values([1, (2, 3), {4: 5}], slurp=True).all()
+
+    assert_equal([[1, [2, 3], {"4": 5}]], result)
+
+
+def test_input_can_be_binary_file():
+    program = jq.compile(".")
+
+    result = program.input_file(io.BytesIO(b"1\n2\n3")).all()
+
+    assert_equal([1, 2, 3], result)
+
+
+def test_input_can_be_text_file():
+    program = jq.compile(".")
+
+    result = program.input_file(io.StringIO("1\n2\n3")).all()
+
+    assert_equal([1, 2, 3], result)
+
+
+def test_file_input_is_parsed_across_multiple_reads():
+    values = [{"id": index, "name": "\u00e9\u20ac" * (index % 50)} for index in range(10000)]
+    text = "\n".join(json.dumps(value, ensure_ascii=False) for value in values)
+    program = jq.compile(".")
+
+    assert_equal(values, program.input_file(io.BytesIO(text.encode("utf8"))).all())
+    assert_equal([values], program.input_file(io.BytesIO(text.encode("utf8")), slurp=True).all())
+
+
+def test_slurping_invalid_input_file_raises_error():
+    program = jq.compile(".")
+
+    try:
+        program.input_file(io.BytesIO(b"1\n{"), slurp=True).all()
+        assert False, "Expected error"
+    except ValueError as error:
+        assert_equal("parse error: Unfinished JSON term at EOF at line 2, column 1", str(error))
+
+
+def test_input_larger_than_parser_buffer_is_parsed_in_slices():
+    text = '1 "\u00e9\u20ac" [2, {"a": 3}]'
+    program = jq.compile(".")
+    original_max_parser_buf_size = jq._MAX_PARSER_BUF_SIZE
+    jq._MAX_PARSER_BUF_SIZE = 3
+    try:
+        assert_equal([1, "\u00e9\u20ac", [2, {"a": 3}]], program.input_text(text).all())
+        assert_equal([[1, "\u00e9\u20ac", [2, {"a": 3}]]], program.input_text(text, slurp=True).all())
+        assert_equal([1, "\u00e9\u20ac", [2, {"a": 3}]], program.input_file(io.BytesIO(text.encode("utf8"))).all())
+        try:
+            program.input_text("1\n{").all()
+            assert False, "Expected error"
+        except ValueError as error:
+            assert_equal("parse error: Unfinished JSON term at EOF at line 2, column 1", str(error))
+    finally:
+        jq._MAX_PARSER_BUF_SIZE = original_max_parser_buf_size
+
+
+def test_input_can_be_msgpack():
+    program = jq.compile(".")
+
+    result = program.input_msgpack(b"\x82\xa1a\x01\xa1b\x93\xc0\xc3\xcb\x40\x09\x21\xf9\xf0\x1b\x86\x6e").first()
+
+    assert_equal({"a": 1, "b": [None, True, 3.14159]}, result)
+
+
+def test_input_can_be_msgpack_with_multiple_concatenated_values():
+    program = jq.compile(". + 1")
+
+    result = program.input_msgpack(b"\x01\xff\xcd\x01\x00\xd1\xfe\xff").all()
+
+    assert_equal([2, 0, 257, -256], result)
+
+
+def test_can_slurp_msgpack_input():
+    program = jq.compile(".")
+
+    result = program.input_msgpack(b"\x01\x02\x03", slurp=True).first()
+
+    assert_equal([1, 2, 3], result)
+
+
+def test_msgpack_input_can_be_any_bytes_like_object():
+    program = jq.compile(".")
+
+    assert_equal([1, 2], program.input_msgpack(bytearray(b"\x01\x02")).all())
+    assert_equal([1, 2], program.input_msgpack(memoryview(b"\x01\x02")).all())
+
+
+def test_type_error_is_raised_if_msgpack_input_is_not_bytes_like():
+    program = jq.compile(".")
+
+    try:
+        program.input_msgpack(5)
+        assert False, "Expected error"
+    except TypeError:
+        pass
+
+
+def test_value_error_is_raised_if_msgpack_input_is_truncated():
+    program = jq.compile(".")
+
+    try:
+        program.input_msgpack(b"\x92\x01").all()
+        assert False, "Expected error"
+    except ValueError as error:
+        assert_equal("parse error: Unfinished MessagePack value at offset 1", str(error))
+
+
+def test_value_error_is_raised_if_msgpack_map_has_non_string_key():
+    program = jq.compile(".")
+
+    try:
+        program.input_msgpack(b"\x81\x01\x02").all()
+        assert False, "Expected error"
+    except ValueError as error:
+        assert_equal("parse error: MessagePack map keys must be strings", str(error))
+
+
+def test_value_error_is_raised_if_msgpack_input_contains_binary_data():
+    program = jq.compile(".")
+
+    try:
+        program.input_msgpack(b"\xc4\x01a").all()
+        assert False, "Expected error"
+    except ValueError as error:
+        assert_equal("parse error: Unsupported MessagePack type 0xc4 at offset 0", str(error))
+
+
 def test_when_text_method_is_used_on_result_then_output_is_serialised_to_json_string():
     assert_equal(
         '"42"',
@@ -154,6 +353,28 @@ def test_elements_in_text_output_are_separated_by_newlines():
     )
 
 
+def test_when_msgpack_method_is_used_on_result_then_output_is_serialised_to_concatenated_msgpack():
+    program = jq.compile(".[]")
+
+    result = program.input_value([{"a": [1, -1]}, "xyz", 1.5, False, None, 300]).msgpack()
+
+    assert_equal(
+        b"\x81\xa1a\x92\x01\xff\xa3xyz\xcb\x3f\xf8\x00\x00\x00\x00\x00\x00\xc2\xc0\xcd\x01\x2c",
+        result,
+    )
+
+
+def test_msgpack_output_clamps_infinities_and_converts_nan_to_nil():
+    program = jq.compile("infinite, -infinite, nan")
+
+    result = program.input_value(None).msgpack()
+
+    assert_equal(
+        b"\xcb\x7f\xef\xff\xff\xff\xff\xff\xff\xcb\xff\xef\xff\xff\xff\xff\xff\xff\xc0",
+        result,
+    )
+
+
 def test_when_first_method_is_used_on_result_then_first_element_of_result_is_returned():
     assert_equal(
         2,
@@ -200,6 +421,65 @@ def test_iterators_from_same_program_and_input_are_independent():
     assert_equal(4, next(second))
 
 
+def test_runner_can_run_program_against_multiple_values_in_turn():
+    runner = jq.compile(".[] + 1").runner()
+
+    assert_equal(2, runner.run_first([1, 2]))
+    assert_equal([4, 5], runner.run_all([3, 4]))
+    assert_equal([], runner.run_all([]))
+
+
+def test_runner_output_matches_output_for_input_value():
+    program = jq.compile("., tojson")
+    runner = program.runner()
+    values = [
+        None, True, False, 0, -5, 2 ** 53, 2 ** 60, 1.0, 1e16, "a\x00b", "\u00e9",
+        [1, [2, {"a": None}]], {"a": 1, "b": 2}, {1: 2}, (1, 2), {"x": (1, 2.5)},
+        "\ud800", {"x": ["\udc00", 1.5]}, object(),
+    ]
+
+    def outcome(run):
+        try:
+            return run()
+        except (TypeError, ValueError) as error:
+            return (type(error), str(error))
+
+    for value in values:
+        assert_equal(
+            outcome(lambda: program.input_value(value).all()),
+            outcome(lambda: runner.run_all(value)),
+        )
+
+
+def test_runner_raises_stop_iteration_from_run_first_when_there_are_no_outputs():
+    runner = jq.compile("empty").runner()
+
+    try:
+        runner.run_first(1)
+        assert False, "Expected error"
+    except StopIteration:
+        pass
+
+
+def test_runner_raises_value_error_if_program_raises_error():
+    runner = jq.compile("if . == 1 then error(\"one\") else . end").runner()
+
+    try:
+        runner.run_first(1)
+        assert False, "Expected error"
+    except ValueError as error:
+        assert_equal("one", str(error))
+
+    assert_equal(2, runner.run_first(2))
+
+
+def test_runner_can_be_used_after_being_closed():
+    with jq.compile(". + 1").runner() as runner:
+        assert_equal(2, runner.run_first(1))
+
+    assert_equal(3, runner.run_first(2))
+
+
 def test_value_error_is_raised_if_program_is_invalid():
     try:
         jq.compile("!")
@@ -307,6 +587,100 @@ def test_program_string_can_be_retrieved_from_program():
     assert_equal(".", program.program_string)
 
 
+def test_importing_jq_does_not_enable_gil_on_free_threaded_builds():
+    if sysconfig.get_config_var("Py_GIL_DISABLED"):
+        assert_equal(False, sys._is_gil_enabled())
+
+
+def test_same_program_can_be_run_concurrently_from_multiple_threads():
+    program = jq.compile(".[] + 1")
+    results = {}
+
+    def run(thread_index):
+        results[thread_index] = [
+            program.input_value([thread_index, iteration]).all()
+            for iteration in range(200)
+        ]
+
+    threads = [threading.Thread(target=run, args=(index, )) for index in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for thread_index in range(8):
+        assert_equal(
+            [[thread_index + 1, iteration + 1] for iteration in range(200)],
+            results[thread_index],
+        )
+
+
+def test_iterator_can_be_consumed_on_different_thread_to_the_one_that_created_it():
+    program = jq.compile(".[]")
+    iterator = iter(program.input_value([1, 2, 3]))
+    assert_equal(1, next(iterator))
+    results = []
+
+    thread = threading.Thread(target=lambda: results.extend(iterator))
+    thread.start()
+    thread.join()
+
+    assert_equal([2, 3], results)
+    assert_equal([1, 2, 3], program.input_value([1, 2, 3]).all())
+
+
+def test_iterator_can_be_shared_between_threads():
+    iterator = iter(jq.compile(".[] | [range(50)] | add").input_value(list(range(2000))))
+    results = []
+
+    def consume():
+        for value in iterator:
+            results.append(value)
+
+    threads = [threading.Thread(target=consume) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert_equal([1225] * 2000, results)
+
+
+def test_iterator_over_slurped_file_can_be_shared_between_threads():
+    text = "\n".join("[{}]".format(index) for index in range(20000))
+    iterator = iter(jq.compile(".[] | .[0]").input_file(io.BytesIO(text.encode("utf8")), slurp=True))
+    results = []
+
+    def consume():
+        for value in iterator:
+            results.append(value)
+
+    threads = [threading.Thread(target=consume) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert_equal(list(range(20000)), sorted(results))
+
+
+def test_runner_can_be_shared_between_threads():
+    runner = jq.compile("[range(.)] | add").runner()
+    results = {}
+
+    def run(thread_index):
+        results[thread_index] = [runner.run_first(value) for value in range(1, 300)]
+
+    threads = [threading.Thread(target=run, args=(index, )) for index in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for thread_index in range(4):
+        assert_equal([value * (value - 1) // 2 for value in range(1, 300)], results[thread_index])
+
+
 class TestJvToPython(object):
     def test_program_preserves_null(self):
         program = jq.compile(".")
@@ -473,3 +847,95 @@ class TestConvenienceFunctions(object):
         assert_equal(3, next(iterator))
         assert_equal(4, next(iterator))
         assert_equal("end", next(iterator, "end"))
+
+
+class TestMapReduce(object):
+    _count_by_key = "reduce .[] as $r ({}; .[$r.k] += 1)"
+    _merge_counts = "reduce .[] as $p ({}; reduce ($p | to_entries[]) as $e (.; .[$e.key] += $e.value))"
+    _lines = ['{"k": "a"}', '{"k": "b"}', '{"k": "a"}', '{"k": "c"}', '{"k": "a"}']
+
+    def test_partial_results_from_chunks_are_merged(self):
+        output = jq.map_reduce(self._count_by_key, self._merge_counts, self._lines, chunk_size=2)
+
+        assert_equal([{"a": 3, "b": 1, "c": 1}], output)
+
+    def test_lines_can_be_read_from_binary_file(self):
+        fileobj = io.BytesIO("\n".join(self._lines).encode("utf8"))
+
+        output = jq.map_reduce(self._count_by_key, self._merge_counts, fileobj, chunk_size=2)
+
+        assert_equal([{"a": 3, "b": 1, "c": 1}], output)
+
+    def test_lines_can_be_bytes(self):
+        output = jq.map_reduce(self._count_by_key, self._merge_counts, "\n".join(self._lines).encode("utf8"), chunk_size=2)
+
+        assert_equal([{"a": 3, "b": 1, "c": 1}], output)
+
+    def test_chunks_can_be_run_using_executor(self):
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            output = jq.map_reduce(
+                self._count_by_key,
+                self._merge_counts,
+                self._lines,
+                chunk_size=1,
+                executor=executor,
+            )
+
+        assert_equal([{"a": 3, "b": 1, "c": 1}], output)
+
+    def test_chunks_can_be_run_using_process_pool_executor(self):
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            output = jq.map_reduce(
+                self._count_by_key,
+                self._merge_counts,
+                self._lines,
+                chunk_size=1,
+                executor=executor,
+            )
+
+        assert_equal([{"a": 3, "b": 1, "c": 1}], output)
+
+    def test_number_of_pending_chunks_can_be_limited(self):
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            output = jq.map_reduce(
+                self._count_by_key,
+                self._merge_counts,
+                self._lines,
+                chunk_size=1,
+                executor=executor,
+                max_pending=1,
+            )
+
+        assert_equal([{"a": 3, "b": 1, "c": 1}], output)
+
+    def test_partial_results_are_merged_in_input_order(self):
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            output = jq.map_reduce(".", "add", "[1]\n[2]\n[3]\n[4]\n[5]", chunk_size=2, executor=executor)
+
+        assert_equal([[[1], [2], [3], [4], [5]]], output)
+
+    def test_when_input_is_empty_then_merge_program_is_run_with_empty_array(self):
+        output = jq.map_reduce(self._count_by_key, self._merge_counts, [])
+
+        assert_equal([{}], output)
+
+    def test_value_error_is_raised_if_chunk_cannot_be_parsed(self):
+        try:
+            jq.map_reduce("length", "add", ["1", "x", "3"], chunk_size=2)
+            assert False, "Expected error"
+        except ValueError as error:
+            assert str(error).startswith("parse error: ")
+
+    def test_value_error_is_raised_if_chunk_size_is_less_than_one(self):
+        try:
+            jq.map_reduce("length", "add", ["1"], chunk_size=0)
+            assert False, "Expected error"
+        except ValueError as error:
+            assert_equal("chunk_size must be at least 1", str(error))
+
+    def test_value_error_is_raised_if_max_pending_is_less_than_one(self):
+        try:
+            jq.map_reduce("length", "add", ["1"], max_pending=0)
+            assert False, "Expected error"
+        except ValueError as error:
+            assert_equal("max_pending must be at least 1", str(error))